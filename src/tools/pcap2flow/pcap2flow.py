@@ -12,46 +12,205 @@ SPDX-License-Identifier: BSD-3-Clause
 """
 
 import argparse
+import queue
+import socket
 import struct
-from scapy.all import *
+import threading
+from scapy.config import conf
+from scapy.layers.inet import IP, TCP, UDP
+# Link layer dissectors of other capture types (PPP, HDLC, PPPoE, 802.11, RadioTap, PPI)
+import scapy.layers.dot11
+import scapy.layers.ppi
+import scapy.layers.ppp
+from scapy.utils import RawPcapNgReader, RawPcapReader
 
 # Dictionary with Transport Sessions
 sessions = {}
+# Maximum number of messages sent to a Transport Session at once
+BATCH_SIZE = 64
+# Messages waiting to be sent to the Transport Session "batch_key"
+batch_key = None
+batch_bufs = []
+# Resolved address candidates of the collector
+collector_addrs = []
+# Maximum number of parsed packets waiting for the sender thread
+QUEUE_SIZE = 4096
+
+LINKTYPE_ETHERNET = 1
+ETH_HDR_LEN = 14
+ETH_TYPE_IPV4 = 0x0800
+IP_PROTOS = {17: "UDP", 6: "TCP"}
+UDP_HDR_LEN = 8
+TCP_HDR_LEN = 20
+
+_ETH_TYPE = struct.Struct("!H")
+_IPV4_HDR = struct.Struct("!BBHHHBBH4s4s")
+_L4_PORTS = struct.Struct("!HH")
+_UDP_LEN = struct.Struct("!H")
+_VERSION = struct.Struct("!H")
 
 def process_pcap():
     """
     Open PCAP and send each NetFlow/IPFIX packet to a collector.
+
+    Packets are read and parsed by the calling thread, while a separate thread sends
+    them to the collector. Both threads are connected by a bounded queue. If reading is
+    interrupted (e.g. by Ctrl-C), the sender thread is not waited for as it might be
+    blocked by a collector that doesn't receive data.
     :return: None
     """
     # Try to open the file
-    reader = PcapReader(args.file)
+    reader = RawPcapReader(args.file)
 
     cnt_total = 0
     cnt_sent = 0
 
-    for pkt in reader:
-        cnt_total += 1
-        if args.verbose:
-            print("Processing {}. packet".format(cnt_total))
-        if process_packet(pkt):
+    pkt_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    errors = []
+    sender = threading.Thread(target=send_worker, args=(pkt_queue, errors), daemon=True)
+    sender.start()
+
+    # Classic PCAP has a single link type, PCAPNG stores it per interface (i.e. per packet)
+    is_pcapng = isinstance(reader, RawPcapNgReader)
+
+    try:
+        for pkt_data, meta in reader:
+            if errors:
+                break
+            cnt_total += 1
+            if args.verbose:
+                print("Processing {}. packet".format(cnt_total))
+            linktype = meta.linktype if is_pcapng else reader.linktype
+            item = parse_packet(pkt_data, linktype)
+            if item is None:
+                continue
+            pkt_queue.put(item)
             cnt_sent += 1
 
+        # Wait until all packets are sent
+        pkt_queue.put(None)
+        sender.join()
+    finally:
+        reader.close()
+
+    if errors:
+        raise errors[0]
+
     print("{} of {} packets have been processed and sent "
         "over {} Transport Session(s)!".format(cnt_sent, cnt_total, len(sessions)))
 
 
+def send_worker(pkt_queue, errors):
+    """
+    Send packets from the queue to a collector until None is received.
+
+    If sending fails, the exception is appended to the list of errors and remaining
+    packets are discarded so the reader is never blocked on a full queue.
+
+    :param pkt_queue: Queue with (key, payload) tuples
+    :param errors:    List where a failure is reported
+    :return: None
+    """
+    try:
+        for key, payload in iter(pkt_queue.get, None):
+            send_packet(key, payload)
+        flush_pending()
+    except Exception as err:
+        errors.append(err)
+        for _ in iter(pkt_queue.get, None):
+            pass
+
+
+def parse_packet(data, linktype):
+    """
+    Extract Transport Session identification and NetFlow v5/v9 or IPFIX payload.
+
+    Non-fragmented IPv4 packets in Ethernet frames are parsed directly from raw bytes.
+    Everything else is dissected by scapy.
+
+    :param bytes data: Raw frame from the PCAP
+    :param int linktype: Link type of the PCAP
+    :return: Tuple (key, payload) or None if the packet should be skipped
+    :rtype: tuple or None
+    """
+    result = None
+    if linktype == LINKTYPE_ETHERNET:
+        result = parse_ipv4_frame(data)
+    if result is None:
+        pkt = conf.l2types.num2layer.get(linktype, conf.raw_layer)(data)
+        result = process_packet(pkt)
+        if result is None:
+            return None
+
+    # Check if the packet contains NetFlow v5/v9 or IPFIX payload
+    raw_payload = result[1]
+    version = _VERSION.unpack_from(raw_payload)[0] if len(raw_payload) >= _VERSION.size else None
+    if version not in [5, 9, 10]:
+        print("Payload doesn't contain NetFlow/IPFIX packet. Skipping...")
+        return None
+    return result
+
+
+def parse_ipv4_frame(data):
+    """
+    Parse Ethernet frame with IPv4 packet carrying UDP or TCP segment.
+
+    :param bytes data: Raw Ethernet frame
+    :return: Tuple (key, payload) or None if the frame is not supported by this parser
+    :rtype: tuple or None
+    """
+    if len(data) < ETH_HDR_LEN + _IPV4_HDR.size:
+        return None
+    if _ETH_TYPE.unpack_from(data, ETH_HDR_LEN - _ETH_TYPE.size)[0] != ETH_TYPE_IPV4:
+        return None
+
+    ver_ihl, _, total_len, _, frag, _, ip_proto, _, ip_src, ip_dst = \
+        _IPV4_HDR.unpack_from(data, ETH_HDR_LEN)
+    proto = IP_PROTOS.get(ip_proto)
+    # Fragments are left to scapy
+    if ver_ihl >> 4 != 4 or ver_ihl & 0x0F < 5 or frag & 0x3FFF or proto is None:
+        return None
+
+    # Ignore Ethernet padding after the end of the IP packet
+    l3_end = min(ETH_HDR_LEN + total_len, len(data))
+    l4_start = ETH_HDR_LEN + (ver_ihl & 0x0F) * 4
+    if proto == "UDP":
+        if l4_start + UDP_HDR_LEN > l3_end:
+            return None
+        l4_len = UDP_HDR_LEN
+        udp_len = _UDP_LEN.unpack_from(data, l4_start + 4)[0]
+        if udp_len < UDP_HDR_LEN:
+            return None
+        # Ignore data after the end of the UDP datagram
+        l3_end = min(l3_end, l4_start + udp_len)
+    else:
+        if l4_start + TCP_HDR_LEN > l3_end:
+            return None
+        # TCP header length is given by the Data Offset field
+        l4_len = (data[l4_start + 12] >> 4) * 4
+        if l4_len < TCP_HDR_LEN:
+            return None
+    if l4_start + l4_len > l3_end:
+        return None
+
+    port_src, port_dst = _L4_PORTS.unpack_from(data, l4_start)
+    key = (socket.inet_ntoa(ip_src), socket.inet_ntoa(ip_dst), proto, port_src, port_dst)
+    return key, data[l4_start + l4_len:l3_end]
+
+
 def process_packet(pkt):
     """
-    Extract NetFlow v5/v9 or IPFIX payload and send it as a new packet to a collector.
+    Extract NetFlow v5/v9 or IPFIX payload from a packet dissected by scapy.
 
-    :param pkt: Scapy packet to process and send
-    :return: True if the packet has been send to the destination. False otherwise.
-    :rtype: bool
+    :param pkt: Scapy packet to process
+    :return: Tuple (key, payload) or None if L3/L4 layer is missing
+    :rtype: tuple or None
     """
     # Determine IP adresses
-    l3_data = pkt.getlayer("IP")
-    if not l3_data:
+    l3_data = pkt.getlayer(IP)
+    if l3_data is None:
         print("Unable to locate L3 layer. Skipping...")
+        return None
     ip_src = l3_data.src
     ip_dst = l3_data.dst
 
@@ -61,11 +220,11 @@ def process_packet(pkt):
     port_src = None
     port_dst = None
 
-    for type in ["UDP", "TCP"]:
-        if not l3_data.haslayer(type):
+    for proto_name, proto_cls in (("UDP", UDP), ("TCP", TCP)):
+        l4_data = l3_data.getlayer(proto_cls)
+        if l4_data is None:
             continue
-        l4_data = l3_data.getlayer(type)
-        proto = type
+        proto = proto_name
         port_src = l4_data.sport
         port_dst = l4_data.dport
         break
@@ -73,20 +232,13 @@ def process_packet(pkt):
     if not proto:
         if args.verbose:
             print("Failed to locate L4 layer. Skipping...")
-        return False
+        return None
 
-    # Check if the packet contains NetFlow v5/v9 or IPFIX payload
     l7_data = l4_data.payload
-    raw_payload = l7_data.original
-    version = struct.unpack("!H", raw_payload[:2])[0]
-    if version not in [5, 9, 10]:
-        print("Payload doesn't contain NetFlow/IPFIX packet. Skipping...")
-        return False
+    raw_payload = l7_data.original if l7_data else b""
 
-    # Send the packet
     key = (ip_src, ip_dst, proto, port_src, port_dst)
-    send_packet(key, raw_payload)
-    return True
+    return key, raw_payload
 
 
 def send_packet(key, payload):
@@ -96,11 +248,20 @@ def send_packet(key, payload):
     To make sure that packets from different Transport Session (TS) are not mixed together,
     the function creates and maintains independent UDP/TCP session for each original TS.
 
+    Packets are not sent immediately. Consecutive packets of the same TS are collected
+    and sent together as soon as a packet of another TS arrives or the batch is full.
+    Call flush_pending() to send the remaining packets.
+
     :param key:   Identification of the original Transport Session
                   (src IP, dst IP, proto, src port, dst port)
     :param payload: Raw NetFlow/IPFIX message to send
     :return: None
     """
+    global batch_key
+    if key != batch_key or len(batch_bufs) >= BATCH_SIZE:
+        flush_pending()
+        batch_key = key
+
     ts = sessions.get(key)
     if not ts:
         # Create a new Transport Session
@@ -118,16 +279,46 @@ def send_packet(key, payload):
         ts = create_socket()
         sessions[key] = ts
 
-    # Send the packet
-    ts.sendall(payload)
+    batch_bufs.append(payload)
 
 
-def create_socket():
+def flush_pending():
     """
-    Create a new socket and connect it to the collector.
+    Send all packets waiting in the batch to their Transport Session.
 
-    :return: Socket
-    :rtype: socket.socket
+    :return: None
+    """
+    if not batch_bufs:
+        return
+    flush_batch(sessions[batch_key], batch_bufs)
+    batch_bufs.clear()
+
+
+def flush_batch(ts, bufs):
+    """
+    Send multiple packets to a connected socket.
+
+    Messages for stream sockets are concatenated and sent at once. Datagrams are sent
+    one by one.
+
+    :param ts:   Connected socket
+    :param bufs: List of raw NetFlow/IPFIX messages to send
+    :return: None
+    """
+    if ts.type != socket.SOCK_DGRAM:
+        ts.sendall(b"".join(bufs))
+        return
+
+    for buf in bufs:
+        ts.sendall(buf)
+
+
+def resolve_collector():
+    """
+    Resolve address of the collector.
+
+    :return: List of address candidates (see socket.getaddrinfo())
+    :rtype: list
     """
     str2proto = {
         "UDP": socket.SOCK_DGRAM,
@@ -140,10 +331,22 @@ def create_socket():
     if args.v6_only:
         family = socket.AF_INET6
 
-    net_proto = str2proto[args.proto]
+    return socket.getaddrinfo(args.addr, args.port, family, str2proto[args.proto])
+
+
+def create_socket():
+    """
+    Create a new socket and connect it to the collector.
+
+    The collector address is taken from the list resolved by resolve_collector(),
+    therefore no DNS query is performed for each new Transport Session.
+
+    :return: Socket
+    :rtype: socket.socket
+    """
     s = None
 
-    for res in socket.getaddrinfo(args.addr, args.port, family, net_proto):
+    for res in collector_addrs:
         net_af, net_type, net_proto, net_cname, net_sa = res
         try:
             s = socket.socket(net_af, net_type, net_proto)
@@ -161,6 +364,12 @@ def create_socket():
 
     if s is None:
         raise RuntimeError("Failed to open socket!")
+
+    # Note: the kernel may limit the size (e.g. by net.core.wmem_max on Linux)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, args.sndbuf)
+    if s.type == socket.SOCK_STREAM:
+        # Do not delay small messages (Nagle's algorithm)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     return s
 
 def arg_check_port(value):
@@ -174,6 +383,17 @@ def arg_check_port(value):
         raise argparse.ArgumentTypeError("%s is not valid port number" % value)
     return num
 
+def arg_check_size(value):
+    """
+    Check if size is positive number
+    :param str value: String to convert
+    :return: Size
+    """
+    num = int(value)
+    if num <= 0:
+        raise argparse.ArgumentTypeError("%s is not valid size" % value)
+    return num
+
 if __name__ == "__main__":
     # Parse arguments
     parser = argparse.ArgumentParser(
@@ -186,6 +406,9 @@ if __name__ == "__main__":
         default=4739, type=arg_check_port)
     parser.add_argument("-t", dest="proto",   help="Connection type (default: %(default)s)",
         default="UDP", choices=["UDP", "TCP"])
+    parser.add_argument("--sndbuf", dest="sndbuf", metavar="SIZE",
+        help="Socket send buffer size in bytes (default: %(default)d)",
+        default=4 * 1024 * 1024, type=arg_check_size)
     parser.add_argument("-v", dest="verbose", help="Increase verbosity", default=False, action="store_true")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-4", dest="v4_only",  help="Force the tool to send flows to an IPv4 address only",
@@ -196,6 +419,7 @@ if __name__ == "__main__":
 
     # Process the PCAP file
     try:
+        collector_addrs = resolve_collector()
         process_pcap()
     except Exception as err:
         print("ERROR: {}".format(err))